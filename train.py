@@ -87,6 +87,7 @@ def main(args):
             logging.info(train_bar.print(dict(**meters, **acc_meters, lr=optimizer.get_lr())))
             utils.save_checkpoint(args, global_step, model, optimizer, score=acc_meters["overall"].avg, mode="max")
 
+    utils.finalize_checkpoints()
     bwt = sum(acc_meters[task].avg - acc for task, acc in acc_tasks.items()) / (len(valid_loaders) - 1)
     logging.info(f"Done training! Final accuracy {acc_meters['overall'].avg:.4f}, backward transfer {bwt:.4f}.")
 
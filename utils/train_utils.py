@@ -2,21 +2,67 @@ import argparse
 import os
 import logging
 import numpy as np
-import pandas as pd
 import random
 import sys
 import io
+import inspect
+import mmap
+import pickle
+import shutil
+import struct
+import atexit
+import functools
+import queue
+import threading
 import torch
-from operator import itemgetter
-from functools import reduce
 import torch.nn.functional as F
-import torch.nn as nn
 from datetime import datetime
 import matplotlib.pyplot as plt
+from matplotlib.lines import Line2D
+from mpl_toolkits.mplot3d import Axes3D  # noqa: F401 (registers the 3d projection)
 import seaborn as sns
 from torch.serialization import default_restore_location
 from sklearn.manifold import TSNE   
 
+try:
+    import liburing
+except ImportError:
+    liburing = None
+
+# The io_uring writer is written against the low-level liburing binding API (e.g. liburing 2024.5.3);
+# later releases renamed it (Ring, Cqe, Iovec), so only use the binding if every name we call exists
+_LIBURING_API = ("io_uring", "io_uring_cqe", "io_uring_queue_init", "io_uring_queue_exit", "io_uring_get_sqe",
+                 "io_uring_prep_writev", "io_uring_submit", "io_uring_wait_cqe", "io_uring_cqe_seen", "iovec")
+if liburing is not None and not all(hasattr(liburing, name) for name in _LIBURING_API):
+    liburing = None
+
+
+def _maybe_compile(**kwargs):
+    # torch.compile is missing before PyTorch 2.0 and can fail when called (e.g. Python 3.12 on PyTorch < 2.4,
+    # Windows) or on the first call (e.g. GPUs unsupported by Triton); fall back to eager mode in all cases
+    def decorator(fn):
+        try:
+            compiled = torch.compile(fn, **kwargs)
+        except Exception as e:
+            logging.warning("torch.compile unavailable for {}, running eagerly: {}".format(fn.__name__, e))
+            return fn
+
+        def wrapper(*args, **kw):
+            if wrapper.checked:
+                return wrapper.impl(*args, **kw)
+            try:
+                result = compiled(*args, **kw)
+            except Exception as e:
+                logging.warning("torch.compile failed for {}, running eagerly: {}".format(fn.__name__, e))
+                wrapper.impl = fn
+                result = fn(*args, **kw)
+            wrapper.checked = True
+            return result
+
+        wrapper.checked, wrapper.impl = False, compiled
+        return functools.wraps(fn)(wrapper)
+    return decorator
+
 def add_logging_arguments(parser):
     parser.add_argument("--seed", default=0, type=int, help="random number generator seed")
     parser.add_argument("--output-dir", default="experiments", help="path to experiment directories")
@@ -27,6 +73,7 @@ def add_logging_arguments(parser):
     parser.add_argument("--no-save", action="store_true", help="don't save models or checkpoints")
     parser.add_argument("--save-interval", type=int, default=1, help="save a checkpoint every N steps")
     parser.add_argument("--step-checkpoints", action="store_true", help="store all step checkpoints")
+    parser.add_argument("--fast-checkpoint", action="store_true", help="store checkpoints as raw tensor buffers instead of torch.save")
     parser.add_argument("--no-log", action="store_true", help="don't save logs to file or Tensorboard directory")
     parser.add_argument("--log-interval", type=int, default=100, help="log every N steps")
     parser.add_argument("--no-visual", action="store_true", help="don't use Tensorboard")
@@ -64,6 +111,9 @@ def setup_experiment(args):
         os.makedirs(args.log_dir, exist_ok=True)
         args.log_file = os.path.join(args.log_dir, "train.log")
 
+    # Filter out callables once rather than on every checkpoint
+    args._serializable = argparse.Namespace(**{k: v for k, v in vars(args).items() if not callable(v)})
+
 
 def init_logging(args):
     stream_handler = logging.StreamHandler()
@@ -76,7 +126,328 @@ def init_logging(args):
         handlers.append(file_handler)
     logging.basicConfig(handlers=handlers, format="[%(asctime)s] %(message)s", datefmt="%Y-%m-%d %H:%M:%S", level=logging.DEBUG)
     logging.info("COMMAND: %s" % " ".join(sys.argv))
-    logging.info("Arguments: {}".format(vars(args)))
+    logging.info("Arguments: {}".format({k: v for k, v in vars(args).items() if not k.startswith("_")}))
+
+
+class _CheckpointWriter(object):
+    """Writes checkpoints on a background thread so that training does not block on disk I/O."""
+
+    def __init__(self):
+        self.queue = queue.Queue()
+        # Only the writer thread serializes, so one buffer can be reused across saves without locking
+        self.buffer = _AlignedBuffer()
+        # First failure of the writer thread, re-raised on the training thread
+        self.error = None
+        self.thread = threading.Thread(target=self._run, name="checkpoint-writer", daemon=True)
+        self.thread.start()
+        atexit.register(self.finalize)
+
+    def enqueue(self, state_dict, paths, ready=None, done=None, serialize=torch.save):
+        # ready: CUDA event marking the end of the host copies, done: set once the state has been written
+        self._raise_error()
+        self.queue.put({"state": state_dict, "paths": paths, "ready": ready, "done": done, "serialize": serialize})
+
+    def finalize(self):
+        self.queue.join()
+        self._raise_error()
+
+    def _raise_error(self):
+        if self.error is not None:
+            raise RuntimeError("Failed to write checkpoint") from self.error
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item["ready"] is not None:
+                    item["ready"].synchronize()
+                primary, aliases = item["paths"][0], item["paths"][1:]
+                # Write to a new inode and rename it into place: existing hard links to the previous file stay
+                # intact and a crash mid-write never corrupts the published checkpoint
+                self.buffer.reset()
+                item["serialize"](item["state"], self.buffer)
+                _write_bytes(primary + ".tmp", self.buffer)
+                os.replace(primary + ".tmp", primary)
+                for alias in aliases:
+                    _link_checkpoint(primary, alias)
+            except Exception as e:
+                logging.exception("Failed to write checkpoint to {}".format(", ".join(item["paths"])))
+                if self.error is None:
+                    self.error = e
+            finally:
+                if item["done"] is not None:
+                    item["done"].set()
+                self.queue.task_done()
+
+
+_WRITE_CHUNK_SIZE = 16 << 20
+
+
+_DIRECT_ALIGNMENT = 4096
+_IO_URING_DEPTH = 8
+
+
+def _align(size, alignment):
+    return -(-size // alignment) * alignment
+
+
+class _AlignedBuffer(object):
+    """Growable file-like buffer backed by page-aligned memory, so checkpoints are serialized straight into
+    memory that can be handed to O_DIRECT without an extra copy."""
+
+    def __init__(self):
+        self.buffer = mmap.mmap(-1, _DIRECT_ALIGNMENT)
+        self.position = self.size = 0
+
+    def reset(self):
+        # Keep the allocation: bytes past size are leftovers of a larger previous checkpoint
+        self.position = self.size = 0
+
+    def reserve(self, size):
+        if len(self.buffer) < size:
+            # Grow geometrically in whole pages so that reallocations stop once the checkpoint size settles
+            buffer = mmap.mmap(-1, _align(max(size, 2 * len(self.buffer)), _DIRECT_ALIGNMENT))
+            with memoryview(buffer) as dst, memoryview(self.buffer) as src:
+                dst[:self.size] = src[:self.size]
+            # Drop (rather than close) the old mapping in case a view of it is still alive
+            self.buffer = buffer
+
+    def write(self, data):
+        with memoryview(data) as view, view.cast("B") as data:
+            end = self.position + len(data)
+            self.reserve(end)
+            self.buffer[self.position:end] = data
+        written, self.position, self.size = end - self.position, end, max(self.size, end)
+        return written
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        base = {io.SEEK_SET: 0, io.SEEK_CUR: self.position, io.SEEK_END: self.size}[whence]
+        self.position = base + offset
+        return self.position
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def view(self, size):
+        self.reserve(size)
+        return memoryview(self.buffer)[:size]
+
+
+_use_io_uring = liburing is not None and hasattr(os, "O_DIRECT")
+
+
+def _write_bytes(path, buffer):
+    global _use_io_uring
+    if _use_io_uring:
+        try:
+            return _write_bytes_io_uring(path, buffer)
+        except Exception as e:
+            # O_DIRECT is not supported by every filesystem (e.g. tmpfs, NFS) and io_uring may be blocked by
+            # seccomp; do not pay for a failing attempt on every save
+            logging.warning("io_uring checkpoint writes disabled, falling back to buffered writes: {}".format(e))
+            _use_io_uring = False
+    _write_bytes_buffered(path, buffer.view(buffer.size))
+
+
+def _write_bytes_buffered(path, data):
+    # Issue a few large writes instead of the many small ones torch.save makes through a file object
+    data = memoryview(data)
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        offset = 0
+        while offset < len(data):
+            offset += os.write(fd, data[offset:offset + _WRITE_CHUNK_SIZE])
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _write_bytes_io_uring(path, buffer):
+    # Bypass the page cache with O_DIRECT, which requires aligned buffers, offsets and lengths
+    size = buffer.size
+    padded = _align(size, _DIRECT_ALIGNMENT)
+    view = buffer.view(padded)
+
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_DIRECT, 0o644)
+    try:
+        ring, cqe = liburing.io_uring(), liburing.io_uring_cqe()
+        # Fails with EPERM/ENOSYS where seccomp blocks io_uring (e.g. Docker's default profile)
+        ret = liburing.io_uring_queue_init(_IO_URING_DEPTH, ring, 0)
+        if isinstance(ret, int) and ret < 0:
+            raise OSError(-ret, os.strerror(-ret))
+        try:
+            offsets = list(range(0, padded, _WRITE_CHUNK_SIZE))
+            for start in range(0, len(offsets), _IO_URING_DEPTH):
+                batch = offsets[start:start + _IO_URING_DEPTH]
+                iovecs = [liburing.iovec(view[offset:offset + _WRITE_CHUNK_SIZE]) for offset in batch]
+                for offset, iov in zip(batch, iovecs):
+                    sqe = liburing.io_uring_get_sqe(ring)
+                    liburing.io_uring_prep_writev(sqe, fd, iov, len(iov), offset)
+                liburing.io_uring_submit(ring)
+
+                # Reap every completion of the batch before raising, so no write is still in flight when the
+                # fd is closed and the buffered fallback reopens the same file
+                written, error = 0, None
+                for _ in batch:
+                    liburing.io_uring_wait_cqe(ring, cqe)
+                    res = cqe.res
+                    liburing.io_uring_cqe_seen(ring, cqe)
+                    if res < 0:
+                        error = error or OSError(-res, os.strerror(-res), path)
+                    else:
+                        written += res
+                if error is not None:
+                    raise error
+                if written != min(padded - batch[0], len(batch) * _WRITE_CHUNK_SIZE):
+                    raise OSError("Short write to {}".format(path))
+
+            # Drop the alignment padding and never trust the kernel to have persisted the data
+            os.ftruncate(fd, size)
+            os.fsync(fd)
+        finally:
+            liburing.io_uring_queue_exit(ring)
+    finally:
+        os.close(fd)
+
+
+def _link_checkpoint(src, dst):
+    # Alias an already written checkpoint instead of serializing the same state again, and publish
+    # it with an atomic rename so that a crash never leaves a partially written dst behind
+    tmp = dst + ".tmp"
+    if os.path.lexists(tmp):
+        os.remove(tmp)
+    try:
+        os.link(src, tmp)
+    except OSError:
+        shutil.copyfile(src, tmp)
+    os.replace(tmp, dst)
+
+
+def _get_checkpoint_writer():
+    if getattr(_get_checkpoint_writer, "writer", None) is None:
+        _get_checkpoint_writer.writer = _CheckpointWriter()
+    return _get_checkpoint_writer.writer
+
+
+def finalize_checkpoints():
+    # Block until all pending checkpoints have been written to disk
+    if getattr(_get_checkpoint_writer, "writer", None) is not None:
+        _get_checkpoint_writer.writer.finalize()
+
+
+def _map_tensors(fn, obj, is_leaf=torch.is_tensor, key=()):
+    # Rebuild nested dicts, lists and tuples, replacing every leaf with fn(leaf, key) where key is its position
+    if is_leaf(obj):
+        return fn(obj, key)
+    if isinstance(obj, dict):
+        mapped = type(obj)((k, _map_tensors(fn, v, is_leaf, key + (k,))) for k, v in obj.items())
+        if hasattr(obj, "_metadata"):
+            mapped._metadata = obj._metadata
+        return mapped
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_map_tensors(fn, v, is_leaf, key + (i,)) for i, v in enumerate(obj))
+    return obj
+
+
+class _CheckpointStager(object):
+    """Copies state dicts into reusable pinned host buffers, alternating between two buffer sets."""
+
+    def __init__(self, num_buffers=2):
+        self.buffers = [{} for _ in range(num_buffers)]
+        self.pending = [None] * num_buffers
+        self.index = 0
+        self.stream = torch.cuda.Stream() if torch.cuda.is_available() else None
+
+    def stage(self, state_dict):
+        index, self.index = self.index, (self.index + 1) % len(self.buffers)
+        # Wait until the writer is done with the state previously staged into these buffers
+        if self.pending[index] is not None:
+            self.pending[index].wait()
+        self.pending[index] = done = threading.Event()
+
+        if self.stream is None:
+            return _map_tensors(functools.partial(self._stage, cache=self.buffers[index]), state_dict), None, done
+
+        # Copy on a side stream and make later (possibly in-place) work on the current stream wait for it
+        self.stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(self.stream):
+            staged = _map_tensors(functools.partial(self._stage, cache=self.buffers[index]), state_dict)
+            ready = torch.cuda.Event()
+            ready.record(self.stream)
+        torch.cuda.current_stream().wait_stream(self.stream)
+        return staged, ready, done
+
+    def _stage(self, tensor, key, cache):
+        buffer = cache.get(key)
+        if buffer is None or buffer.shape != tensor.shape or buffer.dtype != tensor.dtype:
+            buffer = cache[key] = torch.empty_like(tensor, device="cpu", pin_memory=self.stream is not None)
+        return buffer.copy_(tensor.detach(), non_blocking=self.stream is not None)
+
+
+_FAST_CHECKPOINT_MAGIC = b"GCLFAST1"
+_FAST_CHECKPOINT_ALIGNMENT = 64
+
+
+class _TensorRef(object):
+    """Placeholder for a tensor whose raw bytes are stored after the header of a fast checkpoint."""
+
+    def __init__(self, offset, nbytes, dtype, shape):
+        self.offset, self.nbytes = offset, nbytes
+        self.dtype, self.shape = dtype, shape
+
+
+def _serialize_fast(state_dict, f):
+    # Pickle everything but the tensors, whose bytes are appended as-is (layout: magic, header size, header, data)
+    tensors, offset = [], [0]
+
+    def strip(obj, key):
+        tensor = obj.detach().cpu().reshape(-1)
+        ref = _TensorRef(offset[0], tensor.numel() * tensor.element_size(), obj.dtype, tuple(obj.shape))
+        offset[0] += _align(ref.nbytes, _FAST_CHECKPOINT_ALIGNMENT)
+        tensors.append(tensor)
+        return ref
+
+    header = pickle.dumps(_map_tensors(strip, state_dict), protocol=pickle.HIGHEST_PROTOCOL)
+    f.write(_FAST_CHECKPOINT_MAGIC)
+    f.write(struct.pack("<Q", len(header)))
+    f.write(header)
+    # Start the tensor data on an O_DIRECT friendly boundary
+    f.write(bytes(_align(f.tell(), _DIRECT_ALIGNMENT) - f.tell()))
+    for tensor in tensors:
+        data = tensor.view(torch.uint8).numpy()
+        f.write(data)
+        f.write(bytes(_align(len(data), _FAST_CHECKPOINT_ALIGNMENT) - len(data)))
+
+
+def _is_fast_checkpoint(path):
+    with open(path, "rb") as f:
+        return f.read(len(_FAST_CHECKPOINT_MAGIC)) == _FAST_CHECKPOINT_MAGIC
+
+
+def fast_load(path):
+    with open(path, "rb") as f:
+        if f.read(len(_FAST_CHECKPOINT_MAGIC)) != _FAST_CHECKPOINT_MAGIC:
+            raise ValueError("{} is not a fast checkpoint".format(path))
+        header_size, = struct.unpack("<Q", f.read(8))
+        header = pickle.loads(f.read(header_size))
+    data_start = _align(len(_FAST_CHECKPOINT_MAGIC) + 8 + header_size, _DIRECT_ALIGNMENT)
+    # Copy-on-write mapping: pages are read lazily and the tensors stay writable
+    data = np.memmap(path, dtype=np.uint8, mode="c")
+
+    def restore(ref, key):
+        start = data_start + ref.offset
+        return torch.from_numpy(data[start:start + ref.nbytes]).view(ref.dtype).reshape(ref.shape)
+
+    return _map_tensors(restore, header, is_leaf=lambda obj: isinstance(obj, _TensorRef))
+
+
+def _get_checkpoint_stager():
+    if getattr(_get_checkpoint_stager, "stager", None) is None:
+        _get_checkpoint_stager.stager = _CheckpointStager()
+    return _get_checkpoint_stager.stager
 
 
 def save_checkpoint(args, step, model, optimizer=None, scheduler=None, score=None, mode="min"):
@@ -104,20 +475,36 @@ def save_checkpoint(args, step, model, optimizer=None, scheduler=None, score=Non
             "model": [m.state_dict() for m in model] if model is not None else None,
             "optimizer": [o.state_dict() for o in optimizer] if optimizer is not None else None,
             "scheduler": [s.state_dict() for s in scheduler] if scheduler is not None else None,
-            "args": argparse.Namespace(**{k: v for k, v in vars(args).items() if not callable(v)}),
+            "args": getattr(args, "_serializable", None) or argparse.Namespace(**{k: v for k, v in vars(args).items() if not callable(v)}),
         }
 
+        paths = []
         if args.step_checkpoints:
-            torch.save(state_dict, os.path.join(args.checkpoint_dir, "checkpoint{}.pt".format(step)))
+            paths.append(os.path.join(args.checkpoint_dir, "checkpoint{}.pt".format(step)))
         if (score < best_score and mode == "min") or (score > best_score and mode == "max"):
-            torch.save(state_dict, os.path.join(args.checkpoint_dir, "checkpoint_best.pt"))
+            paths.append(os.path.join(args.checkpoint_dir, "checkpoint_best.pt"))
         if step > last_step:
-            torch.save(state_dict, os.path.join(args.checkpoint_dir, "checkpoint_last.pt"))
+            paths.append(os.path.join(args.checkpoint_dir, "checkpoint_last.pt"))
+        if paths:
+            staged, ready, done = _get_checkpoint_stager().stage(state_dict)
+            serialize = _serialize_fast if getattr(args, "fast_checkpoint", False) else torch.save
+            try:
+                _get_checkpoint_writer().enqueue(staged, paths, ready=ready, done=done, serialize=serialize)
+            except Exception:
+                # Nothing will write the staged state, so do not let the next save wait on its buffers
+                done.set()
+                raise
 
 
 def load_checkpoint(args, model=None, optimizer=None, scheduler=None):
+    finalize_checkpoints()
     if args.restore_file is not None and os.path.isfile(args.restore_file):
-        state_dict = torch.load(args.restore_file, map_location=lambda s, l: default_restore_location(s, "cpu"))
+        if _is_fast_checkpoint(args.restore_file):
+            state_dict = fast_load(args.restore_file)
+        else:
+            # Map storages lazily instead of reading the whole file up front (PyTorch >= 2.1)
+            load_args = dict(mmap=True, weights_only=False) if "mmap" in inspect.signature(torch.load).parameters else {}
+            state_dict = torch.load(args.restore_file, map_location=lambda s, l: default_restore_location(s, "cpu"), **load_args)
 
         model = [model] if model is not None and not isinstance(model, list) else model
         optimizer = [optimizer] if optimizer is not None and not isinstance(optimizer, list) else optimizer
@@ -141,41 +528,50 @@ def load_checkpoint(args, model=None, optimizer=None, scheduler=None):
         return state_dict
 
 
+@_maybe_compile(fullgraph=True, dynamic=True)
 def logitexp(logp):
     # Convert outputs of logsigmoid to logits (see https://github.com/pytorch/pytorch/issues/4007)
+    # The pointwise chain is fused into a single kernel when compiled; the clamps keep gradients finite
     pos = torch.clamp(logp, min=-0.69314718056)
     neg = torch.clamp(logp, max=-0.69314718056)
-    neg_val = neg - torch.log(1 - torch.exp(neg))
+    neg_val = neg - torch.log1p(-torch.exp(neg))
     pos_val = -torch.log(torch.clamp(torch.expm1(-pos), min=1e-20))
     return pos_val + neg_val
 
-def bool_mask(target, context, float=False):
-    num_targets, num_contexts = len(target), len(context)
-    mask = torch.eq(target.unsqueeze(-1).expand([num_targets, num_contexts]), context.unsqueeze(0).expand([num_targets, num_contexts]))
+def bool_mask(target, context, float=False, out=None):
+    # Broadcast instead of expanding; `out` lets callers reuse a preallocated [num_targets, num_contexts] mask
+    mask = torch.eq(target.unsqueeze(1), context.unsqueeze(0), out=out)
     if float:
-        return mask.float()  # 1 if context label == target label
+        return mask.to(torch.float32)  # 1 if context label == target label
     else:
         return mask # True if context label == target label
 
-def connectivity(mask, graph, target_labels):
+@_maybe_compile(dynamic=True)
+def _connectivity_impl(mask, graph, target_labels, normalized=False):
+    # Tensors in, tensors out: keeps host syncs out of the compiled region
+    if not normalized:
+        mask, graph = F.normalize(mask,p=1,dim=1), F.normalize(graph,p=1,dim=1)
+    gc = torch.linalg.vector_norm(mask - graph, ord=2, dim=1)
+    # Average the per-target scores of each label with a single grouped reduction
+    labels, inverse = torch.unique(target_labels, return_inverse=True)
+    counts = torch.bincount(inverse, minlength=len(labels)).to(gc.dtype)
+    means = torch.zeros_like(counts).scatter_add_(0, inverse, gc) / counts
+    return labels, means
+
+def connectivity(mask, graph, target_labels, normalized=False):
     """
     target_labels: [Torch.Tensor], size: num_targets
     graph: [Torch.Tensor], size: num_targets, num_contexts
+    normalized: whether mask and graph are already L1-normalized along dim 1
     returns [Torch.Tensor], size: num_targets 
     """
-    label_connectivity = {}
-    pdist = nn.PairwiseDistance(p=2.0)
-    gc = pdist(F.normalize(mask,p=1,dim=1), F.normalize(graph,p=1,dim=1))
-    for i in torch.unique(target_labels):
-        indices = (target_labels==i).nonzero() # list of indices that is i-th label
-        scores = [i for i in itemgetter(*indices)(gc)]
-        scores = torch.stack(scores)
-        label_connectivity[i.item()] = reduce(lambda x,y: x+y, scores).item()/len(scores)
-    return label_connectivity
+    labels, means = _connectivity_impl(mask, graph, target_labels, normalized)
+    return dict(zip(labels.tolist(), means.tolist()))
 
 def plot_svd(embedding, task_id, **kwargs):
-    u, s, v = torch.svd(embedding)
-    s = s.cpu().detach().numpy()
+    # Only the singular values are needed, so skip forming U and V and copy just those to the host
+    s = torch.linalg.svdvals(embedding.detach())
+    s = s.cpu().numpy()
     c = 1-s/np.sum(s, dtype=float)
     figure = plt.figure(figsize=(10,5))
     sns.barplot(x=list(range(1,len(c)+1)),
@@ -189,56 +585,87 @@ def plot_svd(embedding, task_id, **kwargs):
         plt.savefig(os.path.join(args.log_dir,f'svd_eigen_task{task_id}.png'),dpi=100)
     else:
         plt.savefig(f'svd_eigen_task{task_id}.png',dpi=100)
-        
+    # Release the figure, otherwise pyplot keeps every figure (and its renderer) alive for the whole run
+    plt.close(figure)
     return plt
     
+def fit_tsne(embedding, n_components=3, perplexity=40, n_iter=300, random_state=42):
+    """
+    embedding: [Torch.Tensor], size: num_samples, hidden_size
+    returns [np.ndarray], size: num_samples, n_components
+    Uses cuML on the GPU (2D only, i.e. feature_analysis with two columns) or multithreaded openTSNE when installed,
+    and sklearn otherwise
+    """
+    # The optional backends are imported here so that importing utils does not pay for loading them
+    embedding = embedding.detach()
+    if embedding.is_cuda and n_components == 2:
+        try:
+            import cupy
+            from cuml.manifold import TSNE as cuTSNE
+        except ImportError:
+            cuTSNE = None
+        if cuTSNE is not None:
+            tsne = cuTSNE(n_components=n_components, perplexity=perplexity, n_iter=n_iter, random_state=random_state, output_type="numpy")
+            return tsne.fit_transform(cupy.asarray(embedding))
+
+    embedding = embedding.cpu().numpy()
+    try:
+        import openTSNE
+    except ImportError:
+        openTSNE = None
+    if openTSNE is not None:
+        # sklearn counts the 250 early exaggeration iterations as part of n_iter, openTSNE does not
+        early_exaggeration_iter = min(250, n_iter)
+        tsne = openTSNE.TSNE(n_components=n_components, perplexity=perplexity, early_exaggeration_iter=early_exaggeration_iter,
+                             n_iter=n_iter - early_exaggeration_iter, negative_gradient_method="bh" if n_components > 2 else "fft",
+                             n_jobs=-1, random_state=random_state, verbose=True)
+        return np.asarray(tsne.fit(embedding))
+
+    # sklearn renamed n_iter to max_iter in 1.5 and removed n_iter in 1.7
+    iter_arg = "max_iter" if "max_iter" in inspect.signature(TSNE).parameters else "n_iter"
+    tsne = TSNE(n_components=n_components, verbose=1, random_state=random_state, perplexity=perplexity, n_jobs=-1, **{iter_arg: n_iter})
+    return tsne.fit_transform(embedding)
+
 def feature_analysis(embedding, labels,  task_id, columns=["x0","x1","x2"], title="TSNE", **kwargs):
-    from sklearn.manifold import TSNE
-    from mpl_toolkits.mplot3d import Axes3D
-    tsne3 = TSNE(n_components=3, verbose=1,random_state=42, 
-                perplexity=40, n_iter=300)
-    embedding = embedding.cpu().detach().numpy()
+    """
+    columns: names of the TSNE axes; pass two names for a 2D plot, which also enables the cuML backend
+    """
     labels = labels.cpu().detach().numpy()
-    X_tsne = tsne3.fit_transform(embedding)
+    X_tsne = fit_tsne(embedding, n_components=len(columns), perplexity=40, n_iter=300)
     
-    df = pd.DataFrame(X_tsne, columns=columns)
-    df['label'] = labels
     cmap = plt.get_cmap('gist_rainbow')
-    unique_labels = list(set(labels))
-    labels_dict = {label: i for i, label in enumerate(unique_labels)}
+    unique_labels, label_indices = np.unique(labels, return_inverse=True)
     num_colors = len(unique_labels)
-    c = [cmap(1.*labels_dict[label]/num_colors) for label in labels]
+    c = cmap(label_indices / num_colors)  # [N, 4] RGBA array
 
-    df['c'] = c
-    df = df[~df['label'].isna()]
-    ax = plt.figure(figsize=(16,10)).gca(projection='3d')
-    
-    for label, grp in df.groupby('label'):
-        ax.scatter(
-        xs=grp[columns[0]], 
-        ys=grp[columns[1]], 
-        zs=grp[columns[2]], 
-        c=grp['c'], 
-        label=label,
-    )
-    ax.set_xlabel(columns[0])
-    ax.set_ylabel(columns[1])
-    ax.set_zlabel(columns[2])
-    
-    plt.legend(loc='best')
-    if title:
-        plt.title(title)
+    # Draw all points at once and build the legend from proxy handles instead of one scatter per label
+    figure = plt.figure(figsize=(16,10))
+    try:
+        ax = figure.add_subplot(projection='3d' if len(columns) == 3 else None)
+        ax.scatter(*X_tsne.T, c=c)
+        handles = [Line2D([0], [0], marker='o', color=cmap(i / num_colors), label=label, linestyle='')
+                   for i, label in enumerate(unique_labels)]
+        ax.set_xlabel(columns[0])
+        ax.set_ylabel(columns[1])
+        if len(columns) == 3:
+            ax.set_zlabel(columns[2])
 
-    if "arg" in kwargs:
-        args = kwargs.get("arg")
-        plt.savefig(os.path.join(args.log_dir,f'TSNE_final_embedding_Task{task_id}.png'),dpi=100)
-    else:
-        plt.savefig(f'TSNE_final_embedding_Task{task_id}.png',dpi=100)
+        plt.legend(handles=handles, loc='best')
+        if title:
+            plt.title(title)
+
+        if "arg" in kwargs:
+            args = kwargs.get("arg")
+            plt.savefig(os.path.join(args.log_dir,f'TSNE_final_embedding_Task{task_id}.png'),dpi=100)
+        else:
+            plt.savefig(f'TSNE_final_embedding_Task{task_id}.png',dpi=100)
+    finally:
+        plt.close(figure)
     return plt
 
 def sparsity(graph):
-    sp = torch.mean((graph==0).float().sum(dim=1)/ graph.size(1))
-    return sp.item() * 100
+    # Count zeros with an integer reduction instead of materializing a float copy of the graph
+    return (graph == 0).sum(dtype=torch.int64).item() / graph.numel() * 100.0
 
 def combine_graphs(g1, g2):
     """